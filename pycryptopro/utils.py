@@ -2,13 +2,71 @@
 
 import re
 import os
+import sys
+import threading
 
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
 from datetime import datetime
+from itertools import islice
 from pycryptopro.exceptions import (
     ShellCommandError, CertificateChainNotChecked, InvalidSignature, CertificatesNotFound
 )
 from subprocess import Popen, PIPE
 
+try:
+    import re2
+except ImportError:
+    re2 = re
+
+# разделитель блоков сертификатов вида "1-------"
+_RE_CERT_SEP = re.compile(rb'\d+-{7}')
+# строка блока вида "Ключ : значение"; пустые строки, строки без ":" и строки "====" пропускаются.
+# Ключ ищется нежадно с первого непробельного символа, а пробелы в конце значения отрезаются в _parse_line:
+# так регулярное выражение почти не откатывается
+_RE_KV = re.compile(rb'^(?!==)[ \t]*([^:\s][^:\n]*?)[ \t]*:[ \t]*([^\n]*)', re.M)
+# нормализация ключей: "SHA1 Hash" -> "sha1_hash"
+_KEY_TRANS = bytes.maketrans(b' ABCDEFGHIJKLMNOPQRSTUVWXYZ', b'_abcdefghijklmnopqrstuvwxyz')
+# ключи, используемые в _make_cert_object: сразу отдаются интернированными строками
+_KNOWN_KEYS = {
+    k.encode('ascii'): sys.intern(k)
+    for k in ('sha1_hash', 'serial', 'not_valid_before', 'not_valid_after', 'issuer', 'subject')
+}
+# пара вида "CN=значение" в строке Issuer/Subject: ключ (может содержать пробелы, например "ИНН ЮЛ")
+# начинается в начале строки или после ", ", значение продолжается до следующего ", " (запятые без пробела
+# остаются в значении)
+_RE_DN_PAIR = re.compile(r'(?:^|, )([^=,]+?)=([^,]*(?:,(?! )[^,]*)*)')
+
+# начало stderr certmgr, если в хранилище нет сертификатов (не считается ошибкой)
+_EMPTY_MARKER = b'Empty certificate list'
+
+# сколько байт stdout certmgr читать за раз при потоковом разборе
+_STREAM_READ_SIZE = 1 << 16
+
+# stdout cryptcp разбирается через re2 (если установлен google-re2): время поиска линейно от длины вывода
+_RE_ERRCODE = re2.compile(rb'ErrorCode: ([^\]\n]+)\]')
+# код возврата и (если есть) первая строка "Signer: ..." перед ним - за один проход
+_RE_RESPONSE = re2.compile(rb'(?s)(?:Signer: (?P<signer>[^\n]*).*?)?\[ReturnCode: (?P<code>\d+)\]')
+
+
+def _join_path(dirname, filename):
+    """
+    Аналог os.path.join(dirname, filename) для двух компонентов POSIX-пути (модуль рассчитан на UNIX)
+    """
+    if not dirname or filename.startswith('/'):
+        return filename
+    if dirname.endswith('/'):
+        return dirname + filename
+    return f'{dirname}/{filename}'
+
+
+def _decode(data):
+    """
+    Декодирует вывод утилит. Символы, не являющиеся UTF-8 (например, вывод в CP1251), заменяются на U+FFFD
+    """
+    return data.decode('utf-8', 'replace')
+
 
 class ShellCommand(object):
     """
@@ -19,21 +77,42 @@ class ShellCommand(object):
 
     def run_command(self, command, *args, **kwargs):
         """
-        Выполняет комманду shell
+        Выполняет комманду (без промежуточного /bin/sh, аргументы передаются списком)
         """
-        params = ' '.join(args)
-        named_params = ' '.join(['-%s %s' % (k, v) for k, v in kwargs.items() if v is not None])
-        cmd = ' '.join([self.binary, command, params, named_params])
-        proc = Popen(cmd, shell=True, stdout=PIPE, stderr=PIPE)
+        proc = self._popen(command, *args, **kwargs)
 
         return self._parse_response(*proc.communicate())
 
+    def _popen(self, command, *args, **kwargs):
+        """
+        Запускает утилиту. Ошибки запуска (нет файла, нет прав) пробрасываются как ShellCommandError
+        """
+        try:
+            return Popen(self._build_argv(command, *args, **kwargs), stdout=PIPE, stderr=PIPE)
+        except OSError as e:
+            raise ShellCommandError(str(e)) from e
+
+    def _build_argv(self, command, *args, **kwargs):
+        """
+        Формирует список аргументов для Popen
+        """
+        if not args and not kwargs:
+            return [self.binary, command]
+
+        argv = [self.binary, command]
+        argv.extend(args)
+        for k, v in kwargs.items():
+            if v is not None:
+                argv.append('-' + k)
+                argv.append(str(v))
+        return argv
+
     def _parse_response(self, stdout, stderr):
         if stderr:
-            if stderr.startswith('Empty certificate list'):
+            if stderr.startswith(_EMPTY_MARKER):
                 return None
             else:
-                raise ShellCommandError(stderr)
+                raise ShellCommandError(_decode(stderr))
         return stdout
 
 
@@ -42,73 +121,166 @@ class Certmgr(ShellCommand):
     Обертка над утилитой certmgr, входящей в состав Крипто-Про CSP (для UNIX-платформ).
     """
 
+    cache_size = 256
+
+    _cache = OrderedDict()
+    _cache_lock = threading.Lock()
+    # увеличивается при каждой очистке кэша: результат list(), начатого до очистки, не кэшируется
+    _cache_generation = 0
+
     def __init__(self, binary='/opt/cprocsp/bin/amd64/certmgr'):
         self.binary = binary
 
     def list(self, *args, **kwargs):
         """
-        Возвращает список сертификатов
+        Возвращает список сертификатов.
+        stdout certmgr разбирается по мере вывода, не дожидаясь завершения процесса
         """
         limit = kwargs.pop('limit', None)
-        stdout = self.run_command('-list', *args, **kwargs)
-        if stdout:
-            return self._parse(stdout, limit)
-        return []
+        proc = self._popen('-list', *args, **kwargs)
+
+        stderr = []
+        eof = threading.Event()
+        drain = threading.Thread(target=lambda: stderr.append(proc.stderr.read()))
+        drain.daemon = True
+        drain.start()
+
+        try:
+            try:
+                res = self._parse(self._iter_blocks(proc.stdout, eof), limit)
+            finally:
+                # если stdout закрыт до EOF (limit), certmgr может завершиться по SIGPIPE или с ошибкой записи
+                proc.stdout.close()
+                proc.wait()
+                drain.join()
+                proc.stderr.close()
+        except Exception:
+            # stdout завершившегося с ошибкой certmgr может быть оборван: сообщаем ошибку certmgr
+            self._check_list_result(proc.returncode, stderr, eof.is_set(), parse_failed=True)
+            raise
+
+        self._check_list_result(proc.returncode, stderr, eof.is_set())
+        return res
+
+    def _check_list_result(self, returncode, stderr, eof, parse_failed=False):
+        """
+        Проверяет результат certmgr -list. Если stdout был закрыт до EOF, результат не проверяется:
+        certmgr остановлен нами, а не завершился сам
+        """
+        if not eof:
+            return
+
+        self._parse_response(None, stderr[0] if stderr else b'')
+        if parse_failed and returncode:
+            raise ShellCommandError('certmgr exited with code {}'.format(returncode))
 
     def inst(self, *args, **kwargs):
         """
         Устанавливает сертификат
         """
-        return self.run_command('-inst', **kwargs)
+        try:
+            return self.run_command('-inst', **kwargs)
+        finally:
+            self.invalidate_cache()
 
     def delete(self, *args, **kwargs):
         """
         Удаляет сертификат
         """
-        return self.run_command('-delete', **kwargs)
+        try:
+            return self.run_command('-delete', **kwargs)
+        finally:
+            self.invalidate_cache()
 
     def get(self, thumbprint, store='uMy'):
         """
-        Возвращает информацию о сертификате
+        Возвращает информацию о сертификате.
+        Найденные сертификаты кэшируются, см. invalidate_cache
         """
-        res = self.list(thumbprint=thumbprint, store=store)
-        if res:
-            return res[0]
+        return self._get_cached(thumbprint, store)
 
-    def _parse(self, text, limit=None):
+    def invalidate_cache(self):
         """
-        Парсит stdout. Возвращает список экземпляров класса Certificate
+        Очищает кэш сертификатов, заполняемый методом get
         """
-        res = []
-        sep = re.compile(r'\d+-{7}')
+        with self._cache_lock:
+            self._cache.clear()
+            Certmgr._cache_generation += 1
+
+    def _get_cached(self, thumbprint, store):
+        key = (self.binary, thumbprint, store)
+        with self._cache_lock:
+            cert = self._cache.get(key)
+            if cert is not None:
+                self._cache.move_to_end(key)
+                return cert
+            generation = self._cache_generation
 
-        for i, item in enumerate(sep.split(text)[1:], start=1):
-            cert_data = {}
-            for line in item.split('\n'):
-                if line == '' or ':' not in line:
-                    continue
+        res = self.list(thumbprint=thumbprint, store=store)
+        if not res:
+            return None
+
+        cert = res[0]
+        with self._cache_lock:
+            if generation != self._cache_generation:
+                return cert
+            self._cache[key] = cert
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return cert
 
-                if line.startswith('=='):
-                    break
+    @staticmethod
+    def _iter_blocks(stream, eof):
+        """
+        Читает stdout certmgr по мере вывода и возвращает (генератор) блоки отдельных сертификатов.
+        Когда stdout прочитан до конца, устанавливает событие eof (до выдачи последнего блока)
+        """
+        # buf всегда начинается сразу после разделителя (или с начала stdout, где идет заголовок certmgr)
+        buf = b''
+        started = False
+        while True:
+            chunk = stream.read1(_STREAM_READ_SIZE)
+            if not chunk:
+                eof.set()
+                break
 
-                key, val = self._parse_line(line)
-                cert_data[key] = val
+            # последний блок может быть еще не дописан (вместе с началом следующего разделителя),
+            # он остается в буфере
+            blocks = _RE_CERT_SEP.split(buf + chunk)
+            buf = blocks.pop()
+            if blocks:
+                yield from (blocks if started else blocks[1:])
+                started = True
 
-            res.append(self._make_cert_object(cert_data))
+        if started:
+            # за последним блоком идет строка "====" и код возврата
+            end = buf.find(b'\n==')
+            yield buf if end == -1 else buf[:end]
 
-            if limit and i == limit:
-                break
+    def _parse(self, blocks, limit=None):
+        """
+        Парсит блоки stdout (bytes). Возвращает список экземпляров класса Certificate
+        """
+        if limit:
+            blocks = islice(blocks, limit)
+        return [self._parse_block(block) for block in blocks]
 
-        return res
+    @staticmethod
+    def _parse_block(block):
+        """
+        Преобразует блок stdout с данными одного сертификата в объект Certificate
+        """
+        cert_data = dict(Certmgr._parse_line(key, val) for key, val in _RE_KV.findall(block))
+        return Certmgr._make_cert_object(cert_data)
 
     @staticmethod
-    def _parse_line(line):
+    def _parse_line(key, val):
         """
-        Преобразует строку в пару ключ:значение
+        Преобразует пару ключ:значение из stdout в строки
         """
-        key, val = line.split(':', 1)
-        key = key.strip().lower().replace(' ', '_')
-        val = val.strip()
+        key = key.translate(_KEY_TRANS)
+        key = _KNOWN_KEYS.get(key) or _decode(key)
+        val = _decode(val.rstrip())
 
         if key in ('sha1_hash', 'serial'):
             val = val.replace('0x', '')
@@ -120,58 +292,71 @@ class Certmgr(ShellCommand):
         """
         Преобразует словарь с данными сертификата в объект
         """
-
-        def _str_to_datetime(string):
-            return datetime.strptime(string, '%d/%m/%Y %H:%M:%S UTC')
-
         cert = Certificate(
             thumbprint=data['sha1_hash'],
             serial=data['serial'],
-            valid_from=_str_to_datetime(data['not_valid_before']),
-            valid_to=_str_to_datetime(data['not_valid_after']),
+            valid_from=Certmgr._str_to_datetime(data['not_valid_before']),
+            valid_to=Certmgr._str_to_datetime(data['not_valid_after']),
             issuer=PersonalInfo(data['issuer']),
             subject=PersonalInfo(data['subject'])
         )
         return cert
 
+    @staticmethod
+    def _str_to_datetime(string):
+        """
+        Преобразует дату из stdout certmgr ("18/07/2019 11:32:00 UTC") в datetime.
+        Формат фиксирован, поэтому вместо strptime поля разбираются срезами;
+        между датой и временем certmgr может выводить несколько пробелов
+        """
+        date, time = string.split(None, 2)[:2]
+        # срезы молча вернут неверную дату, если certmgr изменит формат, поэтому он проверяется
+        if not (len(date) == 10 and date[2] == date[5] == '/'
+                and len(time) == 8 and time[2] == time[5] == ':'):
+            raise ValueError('unexpected certmgr date format: {!r}'.format(string))
+        return datetime(
+            int(date[6:10]), int(date[3:5]), int(date[0:2]),
+            int(time[0:2]), int(time[3:5]), int(time[6:8])
+        )
+
+
+@dataclass(slots=True, frozen=True)
+class PersonalInfo:
+    """
+    Данные владельца или издателя сертификата (строка Issuer/Subject)
+    """
 
-class PersonalInfo(object):
-    def __init__(self, line):
-        self.line = line
+    line: str
+    _parsed: dict = field(default=None, init=False, compare=False, repr=False)
 
     def as_string(self):
         return self.line
 
     def as_dict(self):
-        return self._parse(self.line)
+        if self._parsed is None:
+            object.__setattr__(self, '_parsed', self._parse(self.line))
+        return dict(self._parsed)
 
     @staticmethod
     def _parse(line):
-        data = {}
-        for item in line.split(', '):
-            try:
-                k, v = item.split('=')
-                data[k] = v
-            except:
-                pass
-        return data
+        return dict(_RE_DN_PAIR.findall(line))
 
     def __repr__(self):
         return self.as_string()
 
 
-class Certificate(object):
+@dataclass(slots=True, frozen=True)
+class Certificate:
     """
     Сертификат
     """
 
-    def __init__(self, thumbprint, serial, valid_from, valid_to, issuer, subject):
-        self.thumbprint = thumbprint
-        self.serial = serial
-        self.valid_from = valid_from
-        self.valid_to = valid_to
-        self.issuer = issuer
-        self.subject = subject
+    thumbprint: str
+    serial: str
+    valid_from: datetime
+    valid_to: datetime
+    issuer: PersonalInfo
+    subject: PersonalInfo
 
 
 class Cryptcp(ShellCommand):
@@ -183,17 +368,32 @@ class Cryptcp(ShellCommand):
         self.binary = binary
 
     def _parse_response(self, stdout, stderr):
-        if '[ReturnCode: 0]' in stdout:
-            return stdout
+        self._match_response(stdout)
+        return stdout
 
-        match = re.search(r'ErrorCode: (.+)]', stdout)
+    def _run_and_match(self, command, *args, **kwargs):
+        """
+        Выполняет комманду и возвращает результат поиска _RE_RESPONSE по stdout
+        """
+        stdout, _ = self._popen(command, *args, **kwargs).communicate()
+        return self._match_response(stdout)
+
+    def _match_response(self, stdout):
+        """
+        Проверяет код возврата cryptcp. В случае успеха возвращает результат поиска _RE_RESPONSE
+        """
+        response = _RE_RESPONSE.search(stdout)
+        if response and response.group('code') == b'0':
+            return response
+
+        match = _RE_ERRCODE.search(stdout)
         if match:
-            error_code = match.group(1).lower()
+            error_code = match.group(1).lower().decode('ascii', 'replace')
             exception_class = self._get_exception_class(error_code)
             if exception_class:
-                raise exception_class(stdout)
+                raise exception_class(_decode(stdout))
 
-        raise ShellCommandError(stdout)
+        raise ShellCommandError(_decode(stdout))
 
     def _get_exception_class(self, error_code):
         exception_classes = {
@@ -237,7 +437,7 @@ class Cryptcp(ShellCommand):
         :param errchain: кидать ошибку если не удалось проверить цепочку сертификатов
         """
 
-        file_path = os.path.join(sgn_dir, filename)
+        file_path = _join_path(sgn_dir, filename)
         args = [file_path]
 
         if errchain:
@@ -249,18 +449,54 @@ class Cryptcp(ShellCommand):
             args.append('-norev')
 
         if dn is not None:
-            args.append('-dn \'{}\''.format(dn))
+            args.extend(['-dn', dn])
 
         kwargs = {
             'dir': sgn_dir,
-            'f': os.path.join(sgn_dir, cert_filename)
+            'f': _join_path(sgn_dir, cert_filename)
         }
 
-        stdout = self.run_command('-vsignf', *args, **kwargs)
-        signer_data = self._get_signer_data(stdout)
+        response = self._run_and_match('-vsignf', *args, **kwargs)
+        signer_data = self._get_signer_data(response)
         return signer_data
 
-    def _get_signer_data(self, stdout):
-        pattern = r'Signer: (.*)'
-        m = re.search(pattern, stdout)
-        return m.group(1)
+    def verify_many(self, items):
+        """
+        Проверяет несколько отделенных подписей параллельно, запуская cryptcp в пуле потоков.
+        Если какая-либо проверка завершилась ошибкой, исключение пробрасывается после завершения остальных.
+
+        :param items: список словарей с аргументами для verify
+        :return: список результатов verify в порядке items
+        """
+        items = list(items)
+        if not items:
+            return []
+
+        max_workers = min(32, (os.cpu_count() or 1) * 4, len(items))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(lambda item: self.verify(**item), items))
+
+    def _get_signer_data(self, response):
+        signer = response.group('signer')
+        if signer is not None:
+            return _decode(signer)
+
+
+_singletons_lock = threading.Lock()
+
+
+def __getattr__(name):
+    """
+    Общие для процесса экземпляры pycryptopro.utils.certmgr и pycryptopro.utils.cryptcp
+    (с путями к утилитам по умолчанию). Создаются при первом обращении
+    """
+    factories = {'certmgr': Certmgr, 'cryptcp': Cryptcp}
+    if name not in factories:
+        raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
+
+    with _singletons_lock:
+        instance = globals().get(name)
+        if instance is None:
+            # дальше атрибут находится в модуле напрямую, без вызова __getattr__
+            instance = globals()[name] = factories[name]()
+    return instance
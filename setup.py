@@ -8,4 +8,8 @@ setup(
     author='uishnik',
     license='MIT',
     packages=['pycryptopro'],
+    python_requires='>=3.10',
+    extras_require={
+        're2': ['google-re2'],
+    },
 )
@@ -0,0 +1,362 @@
+# coding: utf-8
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from datetime import datetime
+from pycryptopro.exceptions import InvalidSignature, ShellCommandError
+from pycryptopro.utils import Certmgr, Cryptcp, PersonalInfo
+
+HEADER = (
+    b'\nCertmgr 1.1 (c) "Crypto-Pro",  2007-2019.\n'
+    b'program for managing certificates, CRLs and stores\n\n'
+    + b'=' * 77 + b'\n'
+)
+
+FOOTER = b'=' * 77 + b'\n\n[ErrorCode: 0x00000000]\n'
+
+CERT = (
+    '{n}-------\n'
+    'Issuer              : E=ca@example.ru, C=RU, L=Москва, CN=Тестовый УЦ\n'
+    'Subject             : C=RU, O=Foo, CN=Иванов Иван\n'
+    'Serial              : 0x{n:038X}\n'
+    'SHA1 Hash           : 0x{n:040x}\n'
+    'Not valid before    : 18/07/2019  11:32:00 UTC\n'
+    'Not valid after     : 18/07/2020  11:42:00 UTC\n'
+    'PrivateKey Link     : Yes\n'
+    'OCSP URL            : \n'
+    'Extended Key Usage  : 1.3.6.1.5.5.7.3.4\n'
+    '                      1.3.6.1.5.5.7.3.2\n'
+)
+
+# вывод fake-certmgr: stdout, затем stderr и код возврата. sigpipe задает реакцию на закрытый stdout:
+# SIG_DFL - процесс завершается по сигналу, не дойдя до stderr; SIG_IGN - запись в stdout обрывается
+# с ошибкой, но stderr и код возврата выводятся. Поведение настоящего certmgr здесь не предполагается.
+# Каждый запуск дописывает строку в файл calls
+FAKE_CERTMGR = '''#!{python}
+import os, signal, sys
+open({calls!r}, 'a').write('1\\n')
+signal.signal(signal.SIGPIPE, signal.{sigpipe})
+try:
+    sys.stdout.buffer.write(open({stdout!r}, 'rb').read())
+    sys.stdout.flush()
+except BrokenPipeError:
+    pass
+sys.stderr.buffer.write(open({stderr!r}, 'rb').read())
+sys.stderr.flush()
+os._exit({code})
+'''
+
+
+def make_listing(count):
+    return HEADER + ''.join(CERT.format(n=n) for n in range(1, count + 1)).encode('utf-8') + FOOTER
+
+
+class FakeCertmgrTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.calls = os.path.join(self.tmpdir, 'calls')
+
+    def make_certmgr(self, stdout=b'', stderr=b'', code=0, sigpipe='SIG_DFL'):
+        paths = {}
+        for name, data in (('stdout', stdout), ('stderr', stderr)):
+            paths[name] = os.path.join(self.tmpdir, name)
+            with open(paths[name], 'wb') as f:
+                f.write(data)
+
+        binary = os.path.join(self.tmpdir, 'certmgr')
+        with open(binary, 'w') as f:
+            f.write(FAKE_CERTMGR.format(
+                python=sys.executable, code=code, sigpipe=sigpipe, calls=self.calls, **paths
+            ))
+        os.chmod(binary, 0o755)
+        return Certmgr(binary)
+
+    def spawn_count(self):
+        if not os.path.exists(self.calls):
+            return 0
+        with open(self.calls) as f:
+            return len(f.readlines())
+
+
+class CertmgrListTestCase(FakeCertmgrTestCase):
+
+    def test_full_listing(self):
+        certmgr = self.make_certmgr(make_listing(1000))
+
+        res = certmgr.list(store='My')
+
+        self.assertEqual(len(res), 1000)
+        self.assertEqual(res[0].thumbprint, '%040x' % 1)
+        self.assertEqual(res[-1].serial, '%038X' % 1000)
+        self.assertEqual(res[0].valid_from, datetime(2019, 7, 18, 11, 32))
+        self.assertEqual(res[0].subject.as_dict()['CN'], 'Иванов Иван')
+
+    def test_non_utf8_listing(self):
+        stdout = HEADER + CERT.format(n=1).encode('cp1251') + FOOTER
+        certmgr = self.make_certmgr(stdout)
+
+        cert, = certmgr.list()
+
+        self.assertEqual(cert.thumbprint, '%040x' % 1)
+        self.assertEqual(cert.valid_to, datetime(2020, 7, 18, 11, 42))
+        self.assertEqual(cert.subject.as_dict()['O'], 'Foo')
+        self.assertIn('\ufffd', cert.subject.as_dict()['CN'])
+
+    def test_limit_stops_reading(self):
+        # вывод больше буфера канала: certmgr еще пишет, когда разбор останавливается
+        certmgr = self.make_certmgr(make_listing(1000), b'not reached\n', code=1)
+
+        res = certmgr.list(limit=2)
+
+        self.assertEqual([c.thumbprint for c in res], ['%040x' % 1, '%040x' % 2])
+
+    def test_limit_stops_reading_sigpipe_ignored(self):
+        # certmgr, игнорирующий SIGPIPE, сообщает об ошибке записи и завершается с ненулевым кодом
+        certmgr = self.make_certmgr(make_listing(1000), b'Error: write failed\n', code=1, sigpipe='SIG_IGN')
+
+        res = certmgr.list(limit=2)
+
+        self.assertEqual([c.thumbprint for c in res], ['%040x' % 1, '%040x' % 2])
+
+    def test_limit_equal_to_store_size_checks_stderr(self):
+        certmgr = self.make_certmgr(make_listing(2), b'Error: store is broken\n', code=1)
+
+        with self.assertRaises(ShellCommandError):
+            certmgr.list(limit=2)
+
+    def test_limit_above_store_size_checks_stderr(self):
+        certmgr = self.make_certmgr(make_listing(2), b'Error: store is broken\n', code=1, sigpipe='SIG_IGN')
+
+        with self.assertRaises(ShellCommandError):
+            certmgr.list(limit=3)
+
+    def test_empty_store(self):
+        certmgr = self.make_certmgr(HEADER, b'Empty certificate list\n', code=1)
+
+        self.assertEqual(certmgr.list(), [])
+
+    def test_stderr_error(self):
+        certmgr = self.make_certmgr(HEADER, b'Error: invalid store\n', code=1)
+
+        with self.assertRaises(ShellCommandError) as cm:
+            certmgr.list(store='Nope')
+        self.assertIn('invalid store', str(cm.exception))
+
+    def test_truncated_output_raises_certmgr_error(self):
+        stdout = HEADER + '1-------\nIssuer              : CN=Тестовый УЦ\n'.encode('utf-8')
+        certmgr = self.make_certmgr(stdout, b'Error: read failed\n', code=1)
+
+        with self.assertRaises(ShellCommandError):
+            certmgr.list()
+
+    def test_missing_binary(self):
+        with self.assertRaises(ShellCommandError):
+            Certmgr(os.path.join(self.tmpdir, 'missing')).list()
+
+
+class CertmgrCacheTestCase(FakeCertmgrTestCase):
+
+    def setUp(self):
+        super().setUp()
+        Certmgr().invalidate_cache()
+        self.addCleanup(Certmgr().invalidate_cache)
+        self.certmgr = self.make_certmgr(make_listing(1))
+
+    def test_repeated_get_spawns_once(self):
+        cert = self.certmgr.get('%040x' % 1)
+
+        self.assertIs(self.certmgr.get('%040x' % 1), cert)
+        self.assertEqual(self.spawn_count(), 1)
+
+    def test_invalidation_forces_spawn(self):
+        # inst и delete сами запускают certmgr: учитывается только повторный запуск из get
+        for invalidate in (self.certmgr.invalidate_cache, self.certmgr.inst, self.certmgr.delete):
+            self.certmgr.get('%040x' % 1)
+            before = self.spawn_count()
+            invalidate()
+            spawned = self.spawn_count() - before
+
+            self.certmgr.get('%040x' % 1)
+            self.assertEqual(self.spawn_count(), before + spawned + 1, invalidate.__name__)
+
+    def test_lookup_racing_with_invalidation_not_cached(self):
+        certmgr = self.certmgr
+        list_ = certmgr.list
+
+        def racing_list(*args, **kwargs):
+            # сертификат устанавливается/удаляется, пока идет certmgr -list
+            res = list_(*args, **kwargs)
+            certmgr.invalidate_cache()
+            return res
+
+        certmgr.list = racing_list
+        self.assertIsNotNone(certmgr.get('%040x' % 1))
+        certmgr.list = list_
+
+        certmgr.get('%040x' % 1)
+        self.assertEqual(self.spawn_count(), 2)
+
+    def test_miss_not_cached(self):
+        certmgr = self.make_certmgr(HEADER, b'Empty certificate list\n', code=1)
+
+        self.assertIsNone(certmgr.get('%040x' % 1))
+        self.assertIsNone(certmgr.get('%040x' % 1))
+        self.assertEqual(self.spawn_count(), 2)
+
+    def test_eviction_at_cache_size(self):
+        self.certmgr.cache_size = 2
+        for thumbprint in ('a', 'b', 'a', 'c'):
+            self.certmgr.get(thumbprint)
+        self.assertEqual(self.spawn_count(), 3)
+
+        # "b" вытеснен как давно не использованный, "a" и "c" остались в кэше
+        self.certmgr.get('a')
+        self.certmgr.get('c')
+        self.assertEqual(self.spawn_count(), 3)
+        self.certmgr.get('b')
+        self.assertEqual(self.spawn_count(), 4)
+
+
+class CryptcpTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def make_cryptcp(self, stdout, slow=()):
+        """
+        stdout - вывод fake-cryptcp либо словарь {имя проверяемого файла: вывод}.
+        Во втором случае файлы из slow выводятся с задержкой, а имя каждого выведенного файла
+        дописывается в self.done
+        """
+        binary = os.path.join(self.tmpdir, 'cryptcp')
+        if isinstance(stdout, bytes):
+            stdout = {'stdout': stdout}
+            script = '#!/bin/sh\nexec cat {}/stdout\n'.format(self.tmpdir)
+        else:
+            self.done = os.path.join(self.tmpdir, 'done')
+            script = (
+                '#!/bin/sh\n'
+                'name=${{2##*/}}\n'
+                'case " {slow} " in *" $name "*) sleep 0.5;; esac\n'
+                'cat {dir}/"$name"\n'
+                'echo "$name" >> {done}\n'
+            ).format(slow=' '.join(slow), dir=self.tmpdir, done=self.done)
+
+        for name, data in stdout.items():
+            with open(os.path.join(self.tmpdir, name), 'wb') as f:
+                f.write(data)
+        with open(binary, 'w') as f:
+            f.write(script)
+        os.chmod(binary, 0o755)
+        return Cryptcp(binary)
+
+    def done_names(self):
+        if not os.path.exists(self.done):
+            return []
+        with open(self.done) as f:
+            return f.read().split()
+
+    def test_verify_returns_signer(self):
+        stdout = 'Verifying...\nSigner: CN=Иванов Иван, O=Foo\nSignature\'s verified.\n[ReturnCode: 0]\n'.encode('utf-8')
+        cryptcp = self.make_cryptcp(stdout)
+
+        self.assertEqual(cryptcp.verify('/tmp', 'file.txt.sgn', 'file.txt'), 'CN=Иванов Иван, O=Foo')
+
+    def test_verify_non_utf8_signer(self):
+        stdout = 'Signer: CN=Иванов Иван, O=Foo\n[ReturnCode: 0]\n'.encode('cp1251')
+        cryptcp = self.make_cryptcp(stdout)
+
+        signer = cryptcp.verify('/tmp', 'file.txt.sgn', 'file.txt')
+
+        self.assertTrue(signer.startswith('CN=\ufffd'))
+        self.assertTrue(signer.endswith(', O=Foo'))
+
+    def test_run_command_returns_stdout(self):
+        stdout = b'Signing...\n[ReturnCode: 0]\n'
+        cryptcp = self.make_cryptcp(stdout)
+
+        self.assertEqual(cryptcp.run_command('-signf', '/tmp/file.txt'), stdout)
+
+    def test_error_code(self):
+        cryptcp = self.make_cryptcp(b'Error: bad signature\n[ErrorCode: 0x200001F9]\n[ReturnCode: 1]\n')
+
+        with self.assertRaises(InvalidSignature):
+            cryptcp.verify('/tmp', 'file.txt.sgn', 'file.txt')
+
+    def test_verify_many_keeps_order(self):
+        names = ['a.txt', 'b.txt', 'c.txt']
+        cryptcp = self.make_cryptcp({
+            name: 'Signer: CN={}\n[ReturnCode: 0]\n'.format(name).encode('utf-8') for name in names
+        }, slow=['a.txt'])
+
+        res = cryptcp.verify_many(
+            dict(sgn_dir=self.tmpdir, cert_filename=name + '.sgn', filename=name) for name in names
+        )
+
+        self.assertEqual(res, ['CN=a.txt', 'CN=b.txt', 'CN=c.txt'])
+        # проверки шли параллельно: медленная первая завершилась последней
+        self.assertEqual(self.done_names()[-1], 'a.txt')
+
+    def test_verify_many_empty(self):
+        cryptcp = self.make_cryptcp({})
+
+        self.assertEqual(cryptcp.verify_many([]), [])
+        self.assertEqual(cryptcp.verify_many(iter([])), [])
+        self.assertEqual(self.done_names(), [])
+
+    def test_verify_many_error_raised_after_shutdown(self):
+        cryptcp = self.make_cryptcp({
+            'bad.txt': b'Error: bad signature\n[ErrorCode: 0x200001F9]\n[ReturnCode: 1]\n',
+            'slow.txt': b'Signer: CN=Foo\n[ReturnCode: 0]\n',
+        }, slow=['slow.txt'])
+
+        with self.assertRaises(InvalidSignature):
+            cryptcp.verify_many([
+                dict(sgn_dir=self.tmpdir, cert_filename='bad.txt.sgn', filename='bad.txt'),
+                dict(sgn_dir=self.tmpdir, cert_filename='slow.txt.sgn', filename='slow.txt'),
+            ])
+        # исключение пробрасывается только после завершения остальных проверок
+        self.assertEqual(sorted(self.done_names()), ['bad.txt', 'slow.txt'])
+
+
+class CertmgrStrToDatetimeTestCase(unittest.TestCase):
+
+    def test_matches_strptime(self):
+        for value in ('18/07/2019 11:32:00 UTC', '18/07/2019  11:32:00 UTC', '31/12/2030 23:59:59 UTC'):
+            self.assertEqual(
+                Certmgr._str_to_datetime(value),
+                datetime.strptime(value, '%d/%m/%Y %H:%M:%S UTC')
+            )
+
+    def test_unexpected_format(self):
+        for value in ('2019-07-18 11:32:00 UTC', '18/07/2019 11.32.00 UTC', '18/7/2019 11:32:00 UTC'):
+            with self.assertRaises(ValueError):
+                Certmgr._str_to_datetime(value)
+
+
+class PersonalInfoTestCase(unittest.TestCase):
+
+    def test_as_dict(self):
+        info = PersonalInfo('E=a@b, ИНН ЮЛ=7707083893, OU=Foo, Bar, O=ООО "Рога,Копыта", 1.2.643.100.1=1027700132195')
+
+        self.assertEqual(info.as_dict(), {
+            'E': 'a@b',
+            'ИНН ЮЛ': '7707083893',
+            'OU': 'Foo',
+            'O': 'ООО "Рога,Копыта"',
+            '1.2.643.100.1': '1027700132195',
+        })
+
+    def test_empty_value(self):
+        self.assertEqual(PersonalInfo('CN=, O=x').as_dict(), {'CN': '', 'O': 'x'})
+
+
+if __name__ == '__main__':
+    unittest.main()